@@ -2,13 +2,31 @@
 
 Item class stores information for individual grocery items (not used directly)
 
+ChangeFeed class records changes made to the items of a CheckoutSystem so
+caches and replicas can pull the changes instead of re-reading every item.
+
 CheckoutSystem class registers and maintains a list of items for sale. It also
 provides functions for creating markdowns/specials and calculating item prices
 
 Order class maintains the name and quantity of items being purchased and
 stores the total cost. It provides functions for scanning/removing items. A
 CheckoutSystem object must be provided as input to access list of valid items
-and price calculation functions.
+and price calculation functions. An Order can record a PricingTrace of how
+each line was priced.
+
+ShardedCheckoutSystem class partitions the item list across worker processes
+by consistent hash of the item name. It can be used in place of a
+CheckoutSystem object.
+
+PromotionSimulator class estimates how revenue would change over a set of past
+orders if markdowns, specials or prices were changed, without changing the
+CheckoutSystem.
+
+replay_scan_log function streams a scan event log through Order objects and
+reports the total of each order as it is closed.
+
+SharedCatalog class stores the item list in a shared memory block so worker
+processes can price items without holding their own copies of Item objects.
 
 Usage example:
     import checkout
@@ -28,6 +46,26 @@ Usage example:
     -> 6.75
 """
 
+import bisect
+import copy
+import hashlib
+import math
+import mmap
+import multiprocessing
+import os
+import random
+import sys
+import struct
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from collections.abc import Mapping
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:  # Python < 3.8
+    resource_tracker = shared_memory = None
+
 
 class Item:
     """Stores information for single item used in checkout
@@ -48,16 +86,138 @@ class Item:
         self.markdown = None
         self.special = None
 
+
+ChangeEvent = namedtuple('ChangeEvent', ['seq', 'name', 'field', 'value'])
+ChangeEvent.__doc__ = """A single change made to the items of a CheckoutSystem.
+
+Attributes:
+    seq: int sequence number of the change, starting at 1
+    name: item name as string, or None if the change applies to all items
+    field: what changed, as string:
+        'item': item registered (value is (price, sold_by)) or
+          unregistered (value is None). replaces all earlier changes to it.
+        'price': value is the new price
+        'markdown': value is the discount, or None if removed
+        'special': value is the special parameter list, or None if removed
+        'reset': changes were dropped before they were read. the consumer
+          must re-read all items (name and value are None)
+    value: new value of the field
+"""
+
+
+class ChangeFeed:
+    """Bounded buffer of ChangeEvents with sequence numbers.
+
+    Changes are coalesced as they are recorded: a change removes the earlier
+    changes it replaces (e.g. an earlier price update to the same item), so
+    the buffer holds at most one change per item and field. Only the latest
+    {maxlen} of these changes are kept. Consumers read the changes after a
+    sequence number with since(), or hold a ChangeSubscription that
+    remembers the last change read.
+
+    Attributes:
+        seq: sequence number of the latest change (0 if none)
+    """
+
+    _ITEM_FIELDS = ('item', 'price', 'markdown', 'special')
+
+    def __init__(self, maxlen=1024):
+        self._maxlen = maxlen
+        # (name, field) -> latest ChangeEvent, in sequence order
+        self._events = OrderedDict()
+        self._dropped_seq = 0
+        self.seq = 0
+
+    def append(self, name, field, value):
+        """Records a change and returns its sequence number.
+
+        Earlier changes replaced by this one are removed from the buffer.
+        If the buffer is full, the oldest change is dropped.
+        """
+        if name is None:
+            replaced = [key for key in self._events if key[1] == field]
+        elif field == 'item':
+            replaced = [(name, f) for f in self._ITEM_FIELDS]
+        else:
+            replaced = [(name, field)]
+        for key in replaced:
+            self._events.pop(key, None)
+
+        self.seq += 1
+        self._events[name, field] = ChangeEvent(self.seq, name, field, value)
+        if len(self._events) > self._maxlen:
+            _, event = self._events.popitem(last=False)
+            self._dropped_seq = event.seq
+        return self.seq
+
+    def since(self, seq):
+        """Returns the changes made after sequence number {seq}.
+
+        Changes replaced by a later change (e.g. two price updates to the
+        same item) are left out.
+
+        Args:
+            seq: int sequence number of the last change already read
+
+        Returns:
+            A list of ChangeEvents in sequence order. If a change after {seq}
+            was dropped because the buffer was full, a single 'reset' event
+            is returned instead.
+        """
+        if seq >= self.seq:
+            return []
+        if seq < self._dropped_seq:
+            return [ChangeEvent(self.seq, None, 'reset', None)]
+
+        events = []
+        for key in reversed(self._events):
+            event = self._events[key]
+            if event.seq <= seq:
+                break
+            events.append(event)
+        events.reverse()
+        return events
+
+    def subscribe(self):
+        """Returns a ChangeSubscription that reads changes made from now on."""
+        return ChangeSubscription(self, self.seq)
+
+
+class ChangeSubscription:
+    """Reads changes from a ChangeFeed, remembering the last change read.
+
+    Attributes:
+        seq: sequence number of the last change read
+    """
+
+    def __init__(self, feed, seq):
+        self._feed = feed
+        self.seq = seq
+
+    def poll(self):
+        """Returns the changes made since the last poll.
+
+        See ChangeFeed.since() for the return value.
+        """
+        events = self._feed.since(self.seq)
+        self.seq = self._feed.seq
+        return events
+
+
 class CheckoutSystem:
     """A checkout system that maintains a list of items and calculates prices
 
     Attributes:
         items: dictionary holding Item objects. Item name is stored as key;
           Item object is stored as value.
+        changes: ChangeFeed recording each change made through the methods
+          of this class. changes made to Item objects directly are not
+          recorded.
     """
 
     def __init__(self):
         self.items = {}
+        self.changes = ChangeFeed()
 
     def register_item(self, name, price, sold_by='unit'):
         """Adds item to checkout system.
@@ -77,6 +237,7 @@ class CheckoutSystem:
 
         item = Item(name, price, sold_by)
         self.items[name] = item
+        self.changes.append(name, 'item', (price, sold_by))
 
     def unregister_item(self, name):
         """Removes item from checkout system.
@@ -91,6 +252,7 @@ class CheckoutSystem:
         """
 
         self.items.pop(name)
+        self.changes.append(name, 'item', None)
 
     def update_price(self, name, price):
         """Updates price of an existing item
@@ -108,6 +270,7 @@ class CheckoutSystem:
             raise ValueError('Price must be greater than zero')
 
         self.items[name].price = price
+        self.changes.append(name, 'price', price)
 
     def markdown(self, name, discount):
         """Applies a markdown to an existing item.
@@ -131,6 +294,7 @@ class CheckoutSystem:
             raise ValueError('Discount cannot be < 0 or > than item price')
         else:
             self.items[name].markdown = discount
+            self.changes.append(name, 'markdown', discount)
 
     def remove_markdown(self, name):
         """Removes a markdown from an existing item.
@@ -146,6 +310,7 @@ class CheckoutSystem:
         """
 
         self.items[name].markdown = None
+        self.changes.append(name, 'markdown', None)
 
     def remove_all_markdowns(self):
         """Removes markdown from all items in checkout system.
@@ -157,6 +322,7 @@ class CheckoutSystem:
         """
         for item in self.items.values():
             item.markdown = None
+        self.changes.append(None, 'markdown', None)
 
     def n_for_x(self, name, N, X, limit=None):
         """Applies a N for $X special to an existing item.
@@ -198,6 +364,7 @@ class CheckoutSystem:
 
 
         self.items[name].special = [2, N, X, limit]
+        self.changes.append(name, 'special', [2, N, X, limit])
 
     def buy_n_get_m(self, name, N, M, X, limit=None):
         """Applies a buy N, get M for X% off special to an existing item.
@@ -247,6 +414,7 @@ class CheckoutSystem:
 
 
         self.items[name].special = [3, N, M, X, limit]
+        self.changes.append(name, 'special', [3, N, M, X, limit])
 
     def remove_special(self, name):
         """Removes an existing special applied to an item.
@@ -260,6 +428,7 @@ class CheckoutSystem:
             KeyError if item name does not exist in CheckoutSystem
         """
         self.items[name].special = None
+        self.changes.append(name, 'special', None)
 
     def remove_all_specials(self):
         """Removes all specials applied to all items.
@@ -271,8 +440,9 @@ class CheckoutSystem:
         """
         for item in self.items.values():
             item.special = None
+        self.changes.append(None, 'special', None)
 
-    def calculate_price(self, name, qty):
+    def calculate_price(self, name, qty, branch=None):
         """Calculates the price for a given item and quantity.
 
         Computes price for a given item and quantity. If the item has a
@@ -283,6 +453,8 @@ class CheckoutSystem:
             name: item name as string (e.g. 'soup')
             qty: float or int representing the number of units of the item
              to price
+            branch: optional; list to which the names of the pricing steps
+             taken are appended (see explain_price)
 
         Returns:
             A float representing the total price for {qty} units of an item
@@ -290,24 +462,60 @@ class CheckoutSystem:
 
         item = self.items[name]
         if item.special is None and item.markdown is None:
+            if branch is not None:
+                branch.append('regular')
             return item.price * qty
         elif item.special is None and item.markdown is not None:
+            if branch is not None:
+                branch.append('markdown')
             return (item.price - item.markdown) * qty
         elif item.special is not None:
             params = item.special
             limit = params[-1]
             price = item.price
             if item.markdown is not None:
+                if branch is not None:
+                    branch.append('markdown')
                 price -= item.markdown
             if limit is not None and qty > limit:
+                if branch is not None:
+                    branch.append('limit')
                 return price * (qty-limit) + \
-                    self.calculate_special(params, price, limit)
+                    self.calculate_special(params, price, limit, branch)
             else:
-                return self.calculate_special(params, price, qty)
+                return self.calculate_special(params, price, qty, branch)
+
+    def calculate_prices(self, lines):
+        """Calculates prices for a sequence of item name/quantity pairs.
+
+        Args:
+            lines: iterable of (name, qty) pairs (e.g. scanned_items.items())
 
+        Returns:
+            A list of floats holding the price of each line, in input order.
+        """
+        return [self.calculate_price(name, qty) for name, qty in lines]
 
+    def explain_price(self, name, qty):
+        """Calculates the price for a given item and quantity and the
+        pricing steps taken.
 
-    def calculate_special(self, params, price, qty):
+        Args:
+            name: item name as string (e.g. 'soup')
+            qty: float or int representing the number of units of the item
+
+        Returns:
+            A tuple of the price (as from calculate_price) and a tuple of
+            strings naming the pricing steps taken, from outermost to
+            innermost. for example, ('markdown', 'limit', 'buy_n_get_m',
+            'rem>N') for a marked down item with a buy N, get M special whose
+            limit is exceeded and whose remaining units exceed N.
+        """
+        branch = []
+        price = self.calculate_price(name, qty, branch)
+        return price, tuple(branch)
+
+    def calculate_special(self, params, price, qty, branch=None):
         """Calculates the special price for a given item and quantity.
 
         Args:
@@ -315,6 +523,8 @@ class CheckoutSystem:
             price: float representing regular price of item in USD
             qty: float or int representing the number of units of the item
              to price
+            branch: optional; list to which the names of the pricing steps
+             taken are appended
 
         Returns:
             A float representing the total price for {qty} units of an item
@@ -326,8 +536,12 @@ class CheckoutSystem:
             N = params[1]
             X = params[2]
             if qty >= N:
+                if branch is not None:
+                    branch.extend(['n_for_x', 'qty>=N'])
                 return (qty // N) * X + (qty % N) * price
             else:
+                if branch is not None:
+                    branch.extend(['n_for_x', 'qty<N'])
                 return price * qty
 
         # Buy N, Get M at X% off special
@@ -346,11 +560,17 @@ class CheckoutSystem:
 
                 rem = qty % (N + M)
                 if rem > N:
+                    if branch is not None:
+                        branch.extend(['buy_n_get_m', 'rem>N'])
                     total += (N * price) + ((rem - N) * m_price)
                 else:
+                    if branch is not None:
+                        branch.extend(['buy_n_get_m', 'rem<=N'])
                     total += rem * price
                 return total
             else:
+                if branch is not None:
+                    branch.extend(['buy_n_get_m', 'qty<=N'])
                 return price * qty
 
 class Order():
@@ -371,12 +591,35 @@ class Order():
           return_total() is called, the special will not be applied/removed
           unless an action is triggered to recalculate the total (e.g
           scanning an item, removing item, or calling calculate_total()).
+          merge(), split() and void() only recalculate the lines they change.
+        _line_prices: dictionary holding the price of each line as of the
+          last time it was calculated. the item name is stored as the key.
+        trace: PricingTrace recording each price calculation, or None if
+          this order is not traced.
     """
 
-    def __init__(self, checkout_sys):
+    def __init__(self, checkout_sys, trace_rate=0):
+        """Creates an empty order.
+
+        Args:
+            checkout_sys: CheckoutSystem object holding the items for sale
+            trace_rate: optional; float from 0 to 1 giving the chance that
+              this order records a PricingTrace (e.g. 0.01 traces about 1 in
+              100 orders). tracing is off by default.
+
+        Raises:
+            ValueError if trace_rate is not between 0 and 1
+        """
+        if trace_rate < 0 or trace_rate > 1:
+            raise ValueError('trace_rate must be between 0 and 1')
+
         self.scanned_items = {}
         self._checkout_sys = checkout_sys
         self.total = 0
+        self._line_prices = {}
+        self.trace = None
+        if trace_rate and random.random() < trace_rate:
+            self.trace = PricingTrace()
 
     def scan_item(self, name, qty=1):
         """Adds an item to the order and recalculates total
@@ -430,15 +673,164 @@ class Order():
     def calculate_total(self):
         """Calculates total of items in scanned_items.
 
-        Calculate_total calls the CheckoutSytem method calculate_price() and
+        Calculate_total calls the CheckoutSytem method calculate_prices() and
         sums the prices for each item name/qty pair stored in scanned_items.
         The class attribute 'total' is then updated with the new value.
 
         Args: None
         """
         new_total = 0
-        for k, v in self.scanned_items.items():
-            new_total += self._checkout_sys.calculate_price(k, v)
+        prices = self._price_lines('calculate_total',
+                                   list(self.scanned_items.items()))
+        for price in prices:
+            new_total += price
+        self._line_prices = dict(zip(self.scanned_items, prices))
+        self.total = new_total
+
+    def merge(self, other):
+        """Moves all items from another order into this order.
+
+        Only the lines for items in {other} are recalculated. {other} is left
+        empty with a total of 0.
+
+        Args:
+            other: Order object using the same CheckoutSystem (e.g. a
+              suspended order)
+
+        Raises:
+            ValueError if {other} uses a different CheckoutSystem or is this
+              order
+        """
+        if other is self or other._checkout_sys is not self._checkout_sys:
+            raise ValueError('Orders must be different and share CheckoutSystem')
+
+        for name, qty in other.scanned_items.items():
+            if name in self.scanned_items:
+                self.scanned_items[name] += qty
+            else:
+                self.scanned_items[name] = qty
+        merged = list(other.scanned_items)
+        other.scanned_items = {}
+        other._line_prices = {}
+        other.total = 0
+
+        self._reprice(merged)
+
+    def split(self, lines):
+        """Moves items from this order into a new order.
+
+        Only the lines moved are recalculated in this order.
+
+        Args:
+            lines: dictionary of item name to quantity to move, or a list of
+              item names to move in full. as with remove_item_qty(), a
+              quantity larger than the quantity in the order moves the
+              whole line.
+
+        Returns:
+            A new Order object holding the moved items, with its total
+            calculated. if this order is traced, the new order is traced
+            too, with its own PricingTrace.
+
+        Raises:
+            ValueError:
+                if an item name is not in the order
+                if a quantity is zero or negative
+                if a quantity for an item sold by unit is not an integer
+        """
+        taken = self._take(lines)
+        order = Order(self._checkout_sys)
+        if self.trace is not None:
+            order.trace = PricingTrace(self.trace.spans.maxlen)
+        order.scanned_items = taken
+        order.calculate_total()
+        self._reprice(taken)
+        return order
+
+    def void(self, lines):
+        """Removes items from this order.
+
+        Only the lines removed are recalculated.
+
+        Args:
+            lines: dictionary of item name to quantity to remove, or a list of
+              item names to remove in full. as with remove_item_qty(), a
+              quantity larger than the quantity in the order removes the
+              whole line.
+
+        Raises:
+            ValueError:
+                if an item name is not in the order
+                if a quantity is zero or negative
+                if a quantity for an item sold by unit is not an integer
+        """
+        self._reprice(self._take(lines))
+
+    def _take(self, lines):
+        """Removes quantities from scanned_items and returns them.
+
+        All lines are checked before scanned_items is changed, so nothing is
+        removed if any line is invalid.
+        """
+        if not isinstance(lines, Mapping):
+            lines = dict.fromkeys(lines)
+
+        for name, qty in lines.items():
+            if name not in self.scanned_items:
+                raise ValueError('Item not in order')
+            if qty is not None and qty <= 0:
+                raise ValueError('Qty must be greater than zero')
+            if qty is None or isinstance(qty, int):
+                continue
+            if self._checkout_sys.items[name].sold_by == 'unit':
+                raise ValueError('Qty must be int value for item sold by unit')
+
+        taken = {}
+        for name, qty in lines.items():
+            if qty is None or qty >= self.scanned_items[name]:
+                taken[name] = self.scanned_items.pop(name)
+            else:
+                self.scanned_items[name] -= qty
+                taken[name] = qty
+        return taken
+
+    def _price_lines(self, label, lines):
+        """Prices (name, qty) lines, recording them in the trace if enabled.
+
+        Traced lines are priced one at a time with explain_price() so each
+        can be timed and its pricing steps recorded.
+        """
+        if self.trace is None:
+            return self._checkout_sys.calculate_prices(lines)
+
+        start = time.perf_counter()
+        traced = []
+        for name, qty in lines:
+            line_start = time.perf_counter()
+            price, branch = self._checkout_sys.explain_price(name, qty)
+            duration = time.perf_counter() - line_start
+            traced.append(TraceLine(name, qty, branch, price, line_start,
+                                    duration))
+        self.trace.add(label, start, time.perf_counter() - start, traced)
+        return [line.price for line in traced]
+
+    def _reprice(self, names):
+        """Recalculates the lines for {names} and updates the total.
+
+        Other lines keep their last calculated price.
+        """
+        changed = set(names)
+        for name in changed:
+            self._line_prices.pop(name, None)
+        stale = [name for name in self.scanned_items
+                 if name not in self._line_prices]
+        prices = self._price_lines(
+            'reprice', [(name, self.scanned_items[name]) for name in stale])
+        self._line_prices.update(zip(stale, prices))
+
+        new_total = 0
+        for name in self.scanned_items:
+            new_total += self._line_prices[name]
         self.total = new_total
 
     def return_total(self):
@@ -451,3 +843,1121 @@ class Order():
 
         """
         return self.total
+
+
+TraceLine = namedtuple('TraceLine', [
+    'name', 'qty', 'branch', 'price', 'start', 'duration'])
+TraceLine.__doc__ = """A single line priced while tracing an Order.
+
+Attributes:
+    name: item name as string
+    qty: quantity priced
+    branch: tuple of pricing steps (see CheckoutSystem.explain_price)
+    price: calculated price
+    start: time.perf_counter() value when pricing started, in seconds
+    duration: time taken by explain_price, in seconds
+"""
+
+TraceSpan = namedtuple('TraceSpan', ['label', 'start', 'duration', 'lines'])
+TraceSpan.__doc__ = """A single recalculation of an Order while tracing.
+
+Attributes:
+    label: 'calculate_total', or 'reprice' for merge/split/void
+    start: time.perf_counter() value when the recalculation started
+    duration: time taken, in seconds
+    lines: list of TraceLines priced
+"""
+
+
+class PricingTrace:
+    """Records how each line of an Order was priced and how long it took.
+
+    Only the latest {maxlen} recalculations are kept. The trace can be
+    exported for Chrome trace viewers (chrome://tracing, Perfetto) or as
+    folded stacks for flamegraph tools.
+
+    Attributes:
+        spans: deque of TraceSpans, oldest first
+    """
+
+    def __init__(self, maxlen=1000):
+        self.spans = deque(maxlen=maxlen)
+        self._origin = time.perf_counter()
+
+    def add(self, label, start, duration, lines):
+        """Records a recalculation."""
+        self.spans.append(TraceSpan(label, start, duration, lines))
+
+    def to_chrome_trace(self, pid=0, tid=0):
+        """Returns the trace in Chrome trace event format.
+
+        Args:
+            pid: optional; process id to show in the viewer (e.g. lane)
+            tid: optional; thread id to show in the viewer
+
+        Returns:
+            A dictionary that can be written with json.dump() and loaded by
+            Chrome trace viewers. times are in microseconds from the start
+            of the trace.
+        """
+        events = []
+        for span in self.spans:
+            events.append(self._chrome_event(span.label, span.start,
+                                             span.duration, pid, tid, {}))
+            for line in span.lines:
+                args = {'qty': line.qty, 'price': line.price,
+                        'branch': '/'.join(line.branch)}
+                events.append(self._chrome_event(line.name, line.start,
+                                                 line.duration, pid, tid, args))
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def _chrome_event(self, name, start, duration, pid, tid, args):
+        return {'name': name, 'cat': 'pricing', 'ph': 'X',
+                'ts': (start - self._origin) * 1e6, 'dur': duration * 1e6,
+                'pid': pid, 'tid': tid, 'args': args}
+
+    def to_folded(self):
+        """Returns the trace as folded stacks for flamegraph tools.
+
+        Each line holds a stack of the recalculation label, item name and
+        pricing steps separated by ';', followed by the total time spent in
+        microseconds (e.g. 'calculate_total;soda;n_for_x;qty>=N 12').
+
+        Returns:
+            A string with one stack per line.
+        """
+        totals = {}
+        for span in self.spans:
+            for line in span.lines:
+                stack = ';'.join((span.label, line.name) + line.branch)
+                totals[stack] = totals.get(stack, 0) + line.duration
+        return ''.join('{} {}\n'.format(stack, max(1, round(seconds * 1e6)))
+                       for stack, seconds in totals.items())
+
+
+SimulationResult = namedtuple('SimulationResult', [
+    'revenue', 'revenue_delta', 'discount', 'discount_delta', 'baskets'])
+SimulationResult.__doc__ = """Result of a PromotionSimulator scenario.
+
+Attributes:
+    revenue: total price of all baskets under the scenario
+    revenue_delta: revenue minus revenue with the current CheckoutSystem
+    discount: total savings from markdowns and specials under the scenario
+      (regular price * qty - price, summed over all lines)
+    discount_delta: discount minus discount with the current CheckoutSystem
+    baskets: number of baskets containing an item changed by the scenario
+"""
+
+
+class PromotionSimulator:
+    """Prices past baskets under hypothetical item changes.
+
+    The simulator builds an index from item name to the baskets containing
+    it and prices each distinct item/quantity pair once with the current
+    CheckoutSystem. A scenario is priced by applying its changes to copies
+    of the changed items only; only the lines for those items are priced
+    again, and once per distinct quantity.
+
+    Attributes:
+        revenue: total price of all baskets with the current CheckoutSystem
+        discount: total savings from markdowns and specials with the current
+          CheckoutSystem
+    """
+
+    # CheckoutSystem methods a scenario may call
+    CHANGES = ('update_price', 'markdown', 'remove_markdown', 'n_for_x',
+               'buy_n_get_m', 'remove_special')
+
+    def __init__(self, checkout_sys, baskets):
+        """Indexes and prices the baskets.
+
+        Args:
+            checkout_sys: CheckoutSystem holding the current items. it is
+              not changed by the simulator.
+            baskets: iterable of Order objects or dictionaries of item name
+              to quantity (e.g. Order.scanned_items)
+
+        Raises:
+            KeyError if a basket item does not exist in checkout_sys
+        """
+        self._checkout_sys = checkout_sys
+        self._baskets = {}
+        self._quantities = {}
+        for idx, basket in enumerate(baskets):
+            if isinstance(basket, Order):
+                basket = basket.scanned_items
+            for name, qty in basket.items():
+                self._baskets.setdefault(name, set()).add(idx)
+                counts = self._quantities.setdefault(name, {})
+                counts[qty] = counts.get(qty, 0) + 1
+
+        self._prices = {}
+        self.revenue = 0
+        self.discount = 0
+        for name, counts in self._quantities.items():
+            item = checkout_sys.items[name]
+            for qty, count in counts.items():
+                price = checkout_sys.calculate_price(name, qty)
+                self._prices[name, qty] = price
+                self.revenue += price * count
+                self.discount += (item.price * qty - price) * count
+
+    def simulate(self, changes):
+        """Prices the baskets under a single scenario.
+
+        Args:
+            changes: list of tuples holding a CheckoutSystem method name
+              (one of PromotionSimulator.CHANGES), item name and the other
+              method arguments. for example:
+              [('buy_n_get_m', 'soda', 2, 1, 100, 6),
+               ('markdown', 'soup', 0.25)]
+
+        Returns:
+            A SimulationResult for the scenario.
+
+        Raises:
+            KeyError if an item name does not exist in the CheckoutSystem
+            ValueError if a method name is not supported, or raised by the
+              CheckoutSystem method for invalid arguments
+        """
+        scenario = CheckoutSystem()
+        for change in changes:
+            method, name, args = change[0], change[1], change[2:]
+            if method not in self.CHANGES:
+                raise ValueError('Unsupported change: {}'.format(method))
+            if name not in scenario.items:
+                item = copy.copy(self._checkout_sys.items[name])
+                if item.special is not None:
+                    item.special = list(item.special)
+                scenario.items[name] = item
+            getattr(scenario, method)(name, *args)
+
+        revenue_delta = 0
+        discount_delta = 0
+        baskets = set()
+        for name, item in scenario.items.items():
+            base_price = self._checkout_sys.items[name].price
+            for qty, count in self._quantities.get(name, {}).items():
+                old = self._prices[name, qty]
+                new = scenario.calculate_price(name, qty)
+                revenue_delta += (new - old) * count
+                discount_delta += ((item.price * qty - new) -
+                                   (base_price * qty - old)) * count
+            baskets.update(self._baskets.get(name, ()))
+
+        return SimulationResult(self.revenue + revenue_delta, revenue_delta,
+                                self.discount + discount_delta, discount_delta,
+                                len(baskets))
+
+    def run(self, scenarios):
+        """Prices the baskets under many scenarios.
+
+        Args:
+            scenarios: dictionary of scenario label to list of changes (see
+              simulate())
+
+        Returns:
+            A dictionary of scenario label to SimulationResult.
+        """
+        return {label: self.simulate(changes)
+                for label, changes in scenarios.items()}
+
+
+ReplayStats = namedtuple('ReplayStats', [
+    'events', 'orders', 'unfinished', 'seconds', 'events_per_second'])
+ReplayStats.__doc__ = """Summary of a replay_scan_log run.
+
+Attributes:
+    events: number of scan, remove and close events read
+    orders: number of order totals sent to the sink
+    unfinished: number of orders never closed in the log. their totals
+      are sent to the sink at the end of the log.
+    seconds: time taken, in seconds
+    events_per_second: events / seconds
+"""
+
+
+def _iter_log_lines(path, chunk_size):
+    """Yields the lines of a file, read through a memory map in chunks.
+
+    Chunks end at a line break, so lines are never split between chunks.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = 0
+            while pos < size:
+                end = min(pos + chunk_size, size)
+                if end < size:
+                    newline = mm.rfind(b'\n', pos, end)
+                    if newline == -1:  # line longer than chunk_size
+                        newline = mm.find(b'\n', end)
+                    end = size if newline == -1 else newline + 1
+                chunk = mm[pos:end]
+                pos = end
+                for line in chunk.splitlines():
+                    yield line
+
+
+def replay_scan_log(path, checkout_sys, sink, chunk_size=1 << 20,
+                    closed_window=100000):
+    """Replays a scan event log and sends the total of each order to a sink.
+
+    The log is a text file with one event per line:
+        lane,order_id,action,item,qty
+    where action is 'scan' or 'remove' (item and qty as for
+    Order.scan_item() and Order.remove_item_qty()), or 'close' to end the
+    order (item and qty are left empty). qty is read as an int unless it
+    contains a '.' or exponent. Blank lines and lines starting with '#' are
+    skipped.
+
+    An order is opened by its first scan or remove event. Closing an order
+    that is not open, or any event for one of the last {closed_window}
+    orders closed, is an error, so an order is never reported twice. To
+    keep memory bounded, older closed order ids are forgotten; an event for
+    one of them opens a new order with the same id.
+
+    Only open orders are kept in memory. When an order is closed its total
+    is sent to the sink and the order is dropped. Orders still open at the
+    end of the log are sent to the sink in the order they were opened.
+
+    Args:
+        path: path of the log file
+        checkout_sys: CheckoutSystem object holding the items in the log
+        sink: function called as sink(lane, order_id, total) for each order.
+          lane and order_id are strings.
+        chunk_size: optional; number of bytes parsed at a time
+        closed_window: optional; number of most recently closed order ids
+          remembered to reject events for closed orders
+
+    Returns:
+        A ReplayStats summary, including throughput in events per second.
+
+    Raises:
+        ValueError if a line is malformed, an event is invalid for its
+          order (e.g. removing an item not in the order), an order that
+          is not open is closed, or an event is for a recently closed order
+        KeyError if an item does not exist in checkout_sys
+        errors raised by the order give the line number in their message.
+    """
+    start = time.perf_counter()
+    orders = {}
+    recently_closed = OrderedDict()
+    events = 0
+    closed = 0
+    for lineno, line in enumerate(_iter_log_lines(path, chunk_size), 1):
+        line = line.decode('utf-8').strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split(',')
+        if len(fields) != 5:
+            raise ValueError('line {}: expected 5 fields'.format(lineno))
+        lane, order_id, action, name, qty = fields
+        key = (lane, order_id)
+        events += 1
+
+        try:
+            if key in recently_closed:
+                raise ValueError('order already closed')
+            if action == 'close':
+                if key not in orders:
+                    raise ValueError('order not open')
+                sink(lane, order_id, orders.pop(key).total)
+                closed += 1
+                recently_closed[key] = None
+                if len(recently_closed) > closed_window:
+                    recently_closed.popitem(last=False)
+                continue
+            if action not in ('scan', 'remove'):
+                raise ValueError('unknown action {!r}'.format(action))
+            if '.' in qty or 'e' in qty.lower():
+                qty = float(qty)
+            else:
+                qty = int(qty)
+
+            order = orders.get(key)
+            if order is None:
+                order = orders[key] = Order(checkout_sys)
+            if action == 'scan':
+                order.scan_item(name, qty)
+            else:
+                order.remove_item_qty(name, qty)
+        except (KeyError, ValueError) as e:
+            raise type(e)('line {}: {}'.format(lineno, e)) from e
+
+    for (lane, order_id), order in orders.items():
+        sink(lane, order_id, order.total)
+
+    seconds = time.perf_counter() - start
+    rate = events / seconds if seconds > 0 else 0
+    return ReplayStats(events, closed + len(orders), len(orders), seconds, rate)
+
+
+def _ring_hash(key):
+    """Returns a stable 64-bit hash of a string for the shard ring."""
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class _HashRing:
+    """Consistent hash ring mapping item names to shard ids.
+
+    Each shard is placed on the ring {replicas} times so that items are spread
+    evenly. Adding or removing a shard only moves the items owned by the ring
+    points of that shard.
+    """
+
+    def __init__(self, replicas=64):
+        self._replicas = replicas
+        self._points = []
+        self._owners = []
+
+    def copy(self):
+        ring = _HashRing(self._replicas)
+        ring._points = list(self._points)
+        ring._owners = list(self._owners)
+        return ring
+
+    def add(self, shard_id):
+        for i in range(self._replicas):
+            point = _ring_hash('{}#{}'.format(shard_id, i))
+            idx = bisect.bisect(self._points, point)
+            self._points.insert(idx, point)
+            self._owners.insert(idx, shard_id)
+
+    def remove(self, shard_id):
+        keep = [(p, o) for p, o in zip(self._points, self._owners)
+                if o != shard_id]
+        self._points = [p for p, _ in keep]
+        self._owners = [o for _, o in keep]
+
+    def owner(self, name):
+        if not self._points:
+            raise RuntimeError('No shards available')
+        idx = bisect.bisect(self._points, _ring_hash(name))
+        return self._owners[idx % len(self._points)]
+
+
+def _shard_worker(conn):
+    """Serves CheckoutSystem requests for a single shard over a pipe.
+
+    Requests are (method, args) tuples. Replies are (ok, result) tuples; if ok
+    is False, result holds the exception raised by the method.
+    """
+    checkout_sys = CheckoutSystem()
+    while True:
+        method, args = conn.recv()
+        if method == 'close':
+            conn.close()
+            return
+        try:
+            if method == 'get_item':
+                result = checkout_sys.items[args[0]]
+            elif method == 'names':
+                result = list(checkout_sys.items)
+            elif method == 'export':
+                result = [checkout_sys.items.pop(name) for name in args[0]]
+            elif method == 'import':
+                for item in args[0]:
+                    checkout_sys.items[item.name] = item
+                result = None
+            else:
+                result = getattr(checkout_sys, method)(*args)
+        except Exception as e:
+            conn.send((False, e))
+        else:
+            conn.send((True, result))
+
+
+class _ShardItems(Mapping):
+    """Read-only view of the items held by a ShardedCheckoutSystem.
+
+    Lookups fetch a copy of the Item object from the owning shard, so changes
+    made to the returned Item are not stored.
+    """
+
+    def __init__(self, checkout_sys):
+        self._checkout_sys = checkout_sys
+
+    def __getitem__(self, name):
+        return self._checkout_sys._call(name, 'get_item', name)
+
+    def __iter__(self):
+        for names in self._checkout_sys._broadcast('names'):
+            for name in names:
+                yield name
+
+    def __len__(self):
+        return sum(len(names) for names in self._checkout_sys._broadcast('names'))
+
+
+class ShardedCheckoutSystem(CheckoutSystem):
+    """A checkout system that partitions items across worker processes.
+
+    Items are assigned to shards by consistent hash of the item name. Each
+    shard is a worker process holding a CheckoutSystem for its items and is
+    reached over a pipe. Item methods are forwarded to the owning shard;
+    calculate_prices() sends each shard its lines at once and gathers the
+    results, so an Order prices its lines on all shards in parallel.
+
+    Worker processes must be stopped with close() (or by using the object as
+    a context manager) when the checkout system is no longer needed.
+
+    The object may be shared by threads (e.g. one per lane). Each shard pipe
+    has a lock held from sending a request until its reply is read; calls
+    touching several shards take their locks in shard id order. Shards and
+    the hash ring are replaced as a whole by add_shard()/remove_shard(), so
+    a call always uses a consistent set of shards.
+
+    Attributes:
+        items: read-only mapping of item name to a copy of its Item object.
+          Items must be changed through the CheckoutSystem methods.
+        changes: ChangeFeed recording changes made to items on all shards
+    """
+
+    def __init__(self, shards=2, replicas=64):
+        """Starts the worker processes.
+
+        Args:
+            shards: optional; positive int number of worker processes to start
+            replicas: optional; positive int number of ring points per shard.
+              more points spread items more evenly between shards.
+
+        Raises:
+            ValueError if shards is not a positive integer
+        """
+        if not isinstance(shards, int) or shards < 1:
+            raise ValueError('shards must be positive integer')
+
+        super().__init__()
+        self.items = _ShardItems(self)
+        # (hash ring, dict of shard id to (process, conn, lock)); replaced,
+        # never changed in place, while the shard locks are held
+        self._topology = (_HashRing(replicas), {})
+        self._admin_lock = threading.Lock()
+        self._next_shard_id = 0
+        self._closed = False
+        for _ in range(shards):
+            self.add_shard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def shard_ids(self):
+        """List of ids for the running shards."""
+        return sorted(self._topology[1])
+
+    def add_shard(self):
+        """Starts a new shard and moves its items from the existing shards.
+
+        Only the items now owned by the new shard are moved.
+
+        Returns:
+            The int id of the new shard.
+
+        Raises:
+            RuntimeError if the checkout system is closed
+        """
+        with self._admin_lock:
+            ring, shards, ids, _ = self._acquire(
+                lambda ring, shards: (shards, None))
+            try:
+                shard_id = self._next_shard_id
+                self._next_shard_id += 1
+
+                parent_conn, child_conn = multiprocessing.Pipe()
+                process = multiprocessing.Process(target=_shard_worker,
+                                                  args=(child_conn,),
+                                                  daemon=True)
+                process.start()
+                child_conn.close()
+
+                new_ring = ring.copy()
+                new_ring.add(shard_id)
+                for old_id in ids:
+                    conn = shards[old_id][1]
+                    moved = [name for name in self._send(conn, 'names')
+                             if new_ring.owner(name) == shard_id]
+                    if moved:
+                        items = self._send(conn, 'export', moved)
+                        self._send(parent_conn, 'import', items)
+                new_shards = dict(shards)
+                new_shards[shard_id] = (process, parent_conn,
+                                        threading.Lock())
+                self._topology = (new_ring, new_shards)
+            finally:
+                self._release(shards, ids)
+        return shard_id
+
+    def remove_shard(self, shard_id):
+        """Stops a shard after moving its items to the remaining shards.
+
+        Args:
+            shard_id: int id of the shard to remove
+
+        Raises:
+            KeyError if shard_id does not exist
+            ValueError if shard_id is the last remaining shard
+            RuntimeError if the checkout system is closed
+        """
+        with self._admin_lock:
+            ring, shards, ids, _ = self._acquire(
+                lambda ring, shards: (shards, None))
+            try:
+                if shard_id not in shards:
+                    raise KeyError(shard_id)
+                if len(shards) == 1:
+                    raise ValueError('Cannot remove last shard')
+
+                new_shards = dict(shards)
+                process, conn, _ = new_shards.pop(shard_id)
+                new_ring = ring.copy()
+                new_ring.remove(shard_id)
+                items = self._send(conn, 'export', self._send(conn, 'names'))
+                moved = {}
+                for item in items:
+                    moved.setdefault(new_ring.owner(item.name),
+                                     []).append(item)
+                for new_id, new_items in moved.items():
+                    self._send(new_shards[new_id][1], 'import', new_items)
+                self._topology = (new_ring, new_shards)
+                conn.send(('close', ()))
+                process.join()
+            finally:
+                self._release(shards, ids)
+
+    def close(self):
+        """Stops all worker processes. Items held by the shards are lost.
+
+        Calls in progress on other threads finish first. Any later method
+        call raises RuntimeError.
+        """
+        with self._admin_lock:
+            if self._closed:
+                return
+            ring, shards, ids, _ = self._acquire(
+                lambda ring, shards: (shards, None))
+            try:
+                self._closed = True
+                self._topology = (ring, {})
+                for process, conn, _ in shards.values():
+                    conn.send(('close', ()))
+                    conn.close()
+                for process, _, _ in shards.values():
+                    process.join()
+            finally:
+                self._release(shards, ids)
+
+    def _send(self, conn, method, *args):
+        conn.send((method, args))
+        return self._recv(conn)
+
+    def _recv(self, conn):
+        ok, result = conn.recv()
+        if not ok:
+            raise result
+        return result
+
+    def _check_open(self):
+        if self._closed:
+            raise RuntimeError('checkout system is closed')
+
+    def _acquire(self, select):
+        """Locks the shards chosen by select(ring, shards).
+
+        select returns an iterable of shard ids and any data computed from
+        the ring. Locks are taken in shard id order. If the shards were
+        replaced while waiting, the locks are released and select is called
+        again with the new shards.
+
+        Returns:
+            A tuple of (ring, shards, locked shard ids, data from select).
+            the caller must pass shards and ids to _release().
+        """
+        while True:
+            self._check_open()
+            ring, shards = self._topology
+            selected, data = select(ring, shards)
+            ids = sorted(selected)
+            for shard_id in ids:
+                shards[shard_id][2].acquire()
+            if self._topology[1] is shards:
+                return ring, shards, ids, data
+            self._release(shards, ids)
+
+    def _release(self, shards, ids):
+        for shard_id in reversed(ids):
+            shards[shard_id][2].release()
+
+    def _call(self, name, method, *args):
+        ring, shards, ids, _ = self._acquire(
+            lambda ring, shards: ([ring.owner(name)], None))
+        try:
+            return self._send(shards[ids[0]][1], method, *args)
+        finally:
+            self._release(shards, ids)
+
+    def _broadcast(self, method, *args):
+        ring, shards, ids, _ = self._acquire(
+            lambda ring, shards: (shards, None))
+        try:
+            conns = [shards[shard_id][1] for shard_id in ids]
+            for conn in conns:
+                conn.send((method, args))
+
+            results = []
+            error = None
+            for conn in conns:
+                try:
+                    results.append(self._recv(conn))
+                except Exception as e:  # keep reading so pipes stay in sync
+                    if error is None:
+                        error = e
+            if error is not None:
+                raise error
+            return results
+        finally:
+            self._release(shards, ids)
+
+    def register_item(self, name, price, sold_by='unit'):
+        """Adds item to its owning shard. See CheckoutSystem.register_item."""
+        self._call(name, 'register_item', name, price, sold_by)
+        self.changes.append(name, 'item', (price, sold_by))
+
+    def unregister_item(self, name):
+        """Removes item from its owning shard. See
+        CheckoutSystem.unregister_item."""
+        self._call(name, 'unregister_item', name)
+        self.changes.append(name, 'item', None)
+
+    def update_price(self, name, price):
+        """Updates item price. See CheckoutSystem.update_price."""
+        self._call(name, 'update_price', name, price)
+        self.changes.append(name, 'price', price)
+
+    def markdown(self, name, discount):
+        """Applies a markdown to an item. See CheckoutSystem.markdown."""
+        self._call(name, 'markdown', name, discount)
+        self.changes.append(name, 'markdown', discount)
+
+    def remove_markdown(self, name):
+        """Removes a markdown from an item. See
+        CheckoutSystem.remove_markdown."""
+        self._call(name, 'remove_markdown', name)
+        self.changes.append(name, 'markdown', None)
+
+    def remove_all_markdowns(self):
+        """Removes markdowns from items on all shards."""
+        self._broadcast('remove_all_markdowns')
+        self.changes.append(None, 'markdown', None)
+
+    def n_for_x(self, name, N, X, limit=None):
+        """Applies a N for $X special to an item. See CheckoutSystem.n_for_x."""
+        self._call(name, 'n_for_x', name, N, X, limit)
+        self.changes.append(name, 'special', [2, N, X, limit])
+
+    def buy_n_get_m(self, name, N, M, X, limit=None):
+        """Applies a buy N, get M for X% off special to an item. See
+        CheckoutSystem.buy_n_get_m."""
+        self._call(name, 'buy_n_get_m', name, N, M, X, limit)
+        self.changes.append(name, 'special', [3, N, M, X, limit])
+
+    def remove_special(self, name):
+        """Removes a special from an item. See CheckoutSystem.remove_special."""
+        self._call(name, 'remove_special', name)
+        self.changes.append(name, 'special', None)
+
+    def remove_all_specials(self):
+        """Removes specials from items on all shards."""
+        self._broadcast('remove_all_specials')
+        self.changes.append(None, 'special', None)
+
+    def calculate_price(self, name, qty, branch=None):
+        """Calculates item price on its owning shard. See
+        CheckoutSystem.calculate_price."""
+        if branch is None:
+            return self._call(name, 'calculate_price', name, qty)
+        price, steps = self.explain_price(name, qty)
+        branch.extend(steps)
+        return price
+
+    def explain_price(self, name, qty):
+        """Calculates item price and pricing steps on its owning shard. See
+        CheckoutSystem.explain_price."""
+        return self._call(name, 'explain_price', name, qty)
+
+    def calculate_prices(self, lines):
+        """Calculates prices for item name/quantity pairs on all shards.
+
+        Lines are grouped by owning shard. Every shard is sent its lines before
+        any results are read, so the shards price their lines in parallel.
+
+        Args:
+            lines: iterable of (name, qty) pairs (e.g. scanned_items.items())
+
+        Returns:
+            A list of floats holding the price of each line, in input order.
+
+        Raises:
+            KeyError if an item name does not exist in the checkout system
+            RuntimeError if the checkout system is closed
+        """
+        lines = list(lines)
+
+        def group(ring, shards):
+            batches = {}
+            for idx, (name, qty) in enumerate(lines):
+                batch = batches.setdefault(ring.owner(name), ([], []))
+                batch[0].append(idx)
+                batch[1].append((name, qty))
+            return batches, batches
+
+        ring, shards, ids, batches = self._acquire(group)
+        try:
+            for shard_id in ids:
+                shards[shard_id][1].send(('calculate_prices',
+                                          (batches[shard_id][1],)))
+
+            prices = [0] * len(lines)
+            error = None
+            for shard_id in ids:
+                try:
+                    results = self._recv(shards[shard_id][1])
+                except Exception as e:  # keep reading so pipes stay in sync
+                    if error is None:
+                        error = e
+                    continue
+                for idx, price in zip(batches[shard_id][0], results):
+                    prices[idx] = price
+            if error is not None:
+                raise error
+            return prices
+        finally:
+            self._release(shards, ids)
+
+
+class _SharedItems(Mapping):
+    """Read-only view of the items stored in a SharedCatalog.
+
+    Lookups read the item record from shared memory and return a new Item
+    object, so changes made to the returned Item are not stored.
+    """
+
+    def __init__(self, catalog):
+        self._catalog = catalog
+
+    def __getitem__(self, name):
+        return self._catalog._read_item(name)
+
+    def __iter__(self):
+        return iter(self._catalog._index())
+
+    def __len__(self):
+        return len(self._catalog._index())
+
+
+class SharedCatalog(CheckoutSystem):
+    """A checkout system storing its items in a shared memory block.
+
+    Each item is stored as a fixed size record holding its name, sold_by,
+    price, markdown and special parameters. Other processes open the same
+    block with SharedCatalog.attach() and read records through a memoryview
+    of the block, so no Item objects are shared between processes.
+
+    Only the process that created the catalog may change items. Each change
+    is written in place between two increments of a sequence counter stored
+    in the block header. Readers retry when the counter is odd or changes
+    while a record is read, so they always see a consistent record without
+    taking a lock. If the counter stays odd for longer than read_timeout
+    (e.g. the writer died mid-update), reads raise RuntimeError.
+
+    Readers do not register the block with their resource tracker, so a
+    reader exiting never deletes the block; only the writer's close() does.
+
+    Requires Python 3.8+ (multiprocessing.shared_memory).
+
+    Attributes:
+        items: read-only mapping of item name to a copy of its Item object.
+          Items must be changed through the CheckoutSystem methods.
+        name: name of the shared memory block, passed to attach() by readers
+        changes: ChangeFeed recording changes made by the writer process.
+          the feed is not shared; readers' feeds stay empty.
+        read_timeout: seconds a read waits for an update in progress to
+          finish before raising RuntimeError
+    """
+
+    read_timeout = 1.0
+
+    # header: sequence counter, index generation, number of record slots used
+    _HEADER = struct.Struct('<QQQ')
+    # record: live flag, name, sold_by, price, markdown (nan if None),
+    # special type (0 if None), special parameters, limit (-1 if None)
+    _RECORD = struct.Struct('<B64s16sddBdddq')
+
+    def __init__(self, capacity=1024, name=None, _create=True):
+        """Creates a new shared memory catalog.
+
+        Args:
+            capacity: optional; positive int maximum number of items
+            name: optional; name of the shared memory block. if not
+              provided, a unique name is generated.
+
+        Raises:
+            RuntimeError if multiprocessing.shared_memory is not available
+        """
+        if shared_memory is None:
+            raise RuntimeError('SharedCatalog requires Python 3.8 or newer')
+
+        super().__init__()
+        self.items = _SharedItems(self)
+        if _create:
+            size = self._HEADER.size + capacity * self._RECORD.size
+            self._shm = shared_memory.SharedMemory(name=name, create=True,
+                                                   size=size)
+            self._HEADER.pack_into(self._shm.buf, 0, 0, 0, 0)
+            self._source = CheckoutSystem()
+            self.changes = self._source.changes
+        else:
+            self._shm = self._open_untracked(name)
+            self._source = None
+        self._buf = self._shm.buf
+        self._capacity = ((self._shm.size - self._HEADER.size) //
+                          self._RECORD.size)
+        self._slots = {}
+        self._free_slots = []
+        self._generation = None
+        self.name = self._shm.name
+
+    @classmethod
+    def attach(cls, name):
+        """Opens an existing catalog for reading.
+
+        Args:
+            name: name of the shared memory block (SharedCatalog.name)
+
+        Returns:
+            A SharedCatalog that can price items but not change them.
+        """
+        return cls(name=name, _create=False)
+
+    @staticmethod
+    def _open_untracked(name):
+        """Opens an existing block without registering it with this
+        process' resource tracker, which would unlink it when the process
+        exits."""
+        if sys.version_info >= (3, 13):
+            return shared_memory.SharedMemory(name=name, track=False)
+        shm = shared_memory.SharedMemory(name=name)
+        if os.name == 'posix':
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Closes this process' view of the catalog.
+
+        The process that created the catalog also frees the shared memory
+        block; readers should close before this happens.
+        """
+        if self._buf is None:
+            return
+        self._buf = None
+        self._shm.close()
+        if self._source is not None:
+            self._shm.unlink()
+
+    def _read_header(self):
+        """Returns the header once no update is in progress.
+
+        Spins briefly, then sleeps between reads until read_timeout.
+        """
+        deadline = None
+        spins = 0
+        while True:
+            seq, generation, used = self._HEADER.unpack_from(self._buf, 0)
+            if seq % 2 == 0:
+                return seq, generation, used
+            spins += 1
+            if spins < 1000:
+                continue
+            now = time.perf_counter()
+            if deadline is None:
+                deadline = now + self.read_timeout
+            elif now > deadline:
+                raise RuntimeError('Catalog update did not finish; '
+                                   'writer may have stopped mid-update')
+            time.sleep(0.0001)
+
+    def _index(self):
+        """Returns dict of item name to record slot, rebuilt if items were
+        added or removed since it was last read."""
+        if self._source is not None:
+            return self._slots
+        while True:
+            seq, generation, used = self._read_header()
+            if generation == self._generation:
+                return self._slots
+            slots = {}
+            for slot in range(used):
+                record = self._RECORD.unpack_from(self._buf, self._offset(slot))
+                if record[0]:
+                    slots[record[1].rstrip(b'\0').decode('utf-8')] = slot
+            if self._HEADER.unpack_from(self._buf, 0)[0] == seq:
+                self._slots = slots
+                self._generation = generation
+                return slots
+
+    def _offset(self, slot):
+        return self._HEADER.size + slot * self._RECORD.size
+
+    def _read_item(self, name):
+        while True:
+            seq = self._read_header()[0]
+            slot = self._index()[name]
+            record = self._RECORD.unpack_from(self._buf, self._offset(slot))
+            if self._HEADER.unpack_from(self._buf, 0)[0] == seq:
+                break
+
+        (live, raw_name, sold_by, price, markdown,
+         kind, p1, p2, p3, limit) = record
+        if not live or raw_name.rstrip(b'\0').decode('utf-8') != name:
+            raise KeyError(name)
+        item = Item(name, price, sold_by.rstrip(b'\0').decode('utf-8'))
+        if not math.isnan(markdown):
+            item.markdown = markdown
+        limit = None if limit < 0 else limit
+        if kind == 2:
+            item.special = [2, int(p1), p2, limit]
+        elif kind == 3:
+            item.special = [3, int(p1), int(p2), int(p3), limit]
+        return item
+
+    def _write(self, names, new_generation=False):
+        """Copies items from the writer's CheckoutSystem into shared memory.
+
+        Names no longer in the writer's CheckoutSystem are marked as removed
+        and their slots are reused by later items. Readers rebuild their
+        index when slots change because the generation is incremented.
+        """
+        seq, generation, used = self._HEADER.unpack_from(self._buf, 0)
+        if new_generation:
+            generation += 1
+        self._HEADER.pack_into(self._buf, 0, seq + 1, generation, used)
+        try:
+            for name in names:
+                item = self._source.items.get(name)
+                if item is None:
+                    slot = self._slots.pop(name)
+                    self._free_slots.append(slot)
+                    self._RECORD.pack_into(self._buf, self._offset(slot),
+                                           0, b'', b'', 0, 0, 0, 0, 0, 0, -1)
+                    continue
+                slot = self._slots.get(name)
+                if slot is None:
+                    if self._free_slots:
+                        slot = self._free_slots.pop()
+                    else:
+                        slot = used
+                        used += 1
+                    self._slots[name] = slot
+                self._RECORD.pack_into(self._buf, self._offset(slot),
+                                       *self._pack_item(item))
+        finally:
+            self._HEADER.pack_into(self._buf, 0, seq + 2, generation, used)
+
+    def _pack_item(self, item):
+        markdown = float('nan') if item.markdown is None else item.markdown
+        kind, p1, p2, p3, limit = 0, 0, 0, 0, -1
+        special = item.special
+        if special is not None:
+            kind = special[0]
+            p1, p2 = special[1], special[2]
+            if kind == 3:
+                p3 = special[3]
+            if special[-1] is not None:
+                limit = special[-1]
+        return (1, item.name.encode('utf-8'), item.sold_by.encode('utf-8'),
+                item.price, markdown, kind, p1, p2, p3, limit)
+
+    def _writer(self):
+        if self._source is None:
+            raise RuntimeError('Catalog is read-only in this process')
+        return self._source
+
+    def register_item(self, name, price, sold_by='unit'):
+        """Adds item to the catalog. See CheckoutSystem.register_item.
+
+        Raises:
+            ValueError if price is less than $0.01, the name is longer than
+              64 bytes, sold_by is longer than 16 bytes or the catalog is full
+            RuntimeError if called from a reader process
+        """
+        writer = self._writer()
+        if len(name.encode('utf-8')) > 64 or len(sold_by.encode('utf-8')) > 16:
+            raise ValueError('Name or sold_by too long for catalog record')
+        if name not in self._slots and not self._free_slots:
+            used = self._HEADER.unpack_from(self._buf, 0)[2]
+            if used >= self._capacity:
+                raise ValueError('Catalog is full')
+        writer.register_item(name, price, sold_by)
+        self._write([name], new_generation=True)
+
+    def unregister_item(self, name):
+        """Removes item from the catalog. See CheckoutSystem.unregister_item.
+
+        The record slot of the removed item is reused by the next new item.
+        """
+        self._writer().unregister_item(name)
+        self._write([name], new_generation=True)
+
+    def update_price(self, name, price):
+        """Updates item price. See CheckoutSystem.update_price."""
+        self._writer().update_price(name, price)
+        self._write([name])
+
+    def markdown(self, name, discount):
+        """Applies a markdown to an item. See CheckoutSystem.markdown."""
+        self._writer().markdown(name, discount)
+        self._write([name])
+
+    def remove_markdown(self, name):
+        """Removes a markdown from an item. See
+        CheckoutSystem.remove_markdown."""
+        self._writer().remove_markdown(name)
+        self._write([name])
+
+    def remove_all_markdowns(self):
+        """Removes markdowns from all items in the catalog."""
+        self._writer().remove_all_markdowns()
+        self._write(list(self._slots))
+
+    def n_for_x(self, name, N, X, limit=None):
+        """Applies a N for $X special to an item. See CheckoutSystem.n_for_x."""
+        self._writer().n_for_x(name, N, X, limit)
+        self._write([name])
+
+    def buy_n_get_m(self, name, N, M, X, limit=None):
+        """Applies a buy N, get M for X% off special to an item. See
+        CheckoutSystem.buy_n_get_m."""
+        self._writer().buy_n_get_m(name, N, M, X, limit)
+        self._write([name])
+
+    def remove_special(self, name):
+        """Removes a special from an item. See CheckoutSystem.remove_special."""
+        self._writer().remove_special(name)
+        self._write([name])
+
+    def remove_all_specials(self):
+        """Removes specials from all items in the catalog."""
+        self._writer().remove_all_specials()
+        self._write(list(self._slots))
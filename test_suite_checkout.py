@@ -1,3 +1,11 @@
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
 import checkout
 
@@ -383,5 +391,866 @@ class OrderTest(unittest.TestCase):
         self.order.scan_item('soda')
         self.assertEqual(self.order.return_total(), 2.00)
 
+class OrderSplitTest(unittest.TestCase):
+    def setUp(self):
+        self.co_sys = checkout.CheckoutSystem()
+        self.co_sys.register_item('onion', 1.00, 'lbs')
+        self.co_sys.register_item('soda', 1.00)
+        self.co_sys.register_item('soup', 2.00)
+        self.co_sys.buy_n_get_m('soda', 1, 1, 100, 4)
+        self.order = checkout.Order(self.co_sys)
+        self.order.scan_item('soda', 7)
+        self.order.scan_item('onion', 2.5)
+        self.order.scan_item('soup', 2)
+
+    # total after split matches total of fresh order
+    def test_split(self):
+        self.assertEqual(self.order.return_total(), 11.50)
+        new_order = self.order.split({'soda': 3, 'soup': 5})
+        self.assertEqual(new_order.scanned_items, {'soda': 3, 'soup': 2})
+        self.assertEqual(new_order.return_total(), 6.00)
+        self.assertEqual(self.order.scanned_items, {'soda': 4, 'onion': 2.5})
+        self.assertEqual(self.order.return_total(), 4.50)
+
+    # only changed lines are recalculated
+    def test_split_reprices_changed_lines(self):
+        self.co_sys.update_price('onion', 2.00)
+        self.order.split(['soup'])
+        self.assertEqual(self.order.return_total(), 7.50)  # onion locked in
+        self.order.calculate_total()
+        self.assertEqual(self.order.return_total(), 10.00)
+
+    # void lines by name and quantity
+    def test_void(self):
+        self.order.void({'soda': 6})
+        self.assertEqual(self.order.scanned_items['soda'], 1)
+        self.assertEqual(self.order.return_total(), 7.50)
+        self.order.void(['soda', 'onion', 'soup'])
+        self.assertEqual(self.order.scanned_items, {})
+        self.assertEqual(self.order.return_total(), 0)
+
+    # invalid lines change nothing
+    def test_void_bad_lines(self):
+        self.assertRaises(ValueError, self.order.void, {'soup': 1, 'ham': 1})
+        self.assertRaises(ValueError, self.order.split, {'onion': 1.5,
+                                                         'soda': 1.5})
+        self.assertEqual(self.order.scanned_items['soup'], 2)
+        self.assertEqual(self.order.return_total(), 11.50)
+
+    # zero or negative quantities change nothing
+    def test_bad_qty(self):
+        self.assertRaises(ValueError, self.order.split, {'soda': -2})
+        self.assertRaises(ValueError, self.order.split, {'soda': 0})
+        self.assertRaises(ValueError, self.order.void, {'soup': 1,
+                                                        'onion': -0.5})
+        self.assertEqual(self.order.scanned_items,
+                         {'soda': 7, 'onion': 2.5, 'soup': 2})
+        self.assertEqual(self.order.return_total(), 11.50)
+
+    # merge suspended order back in
+    def test_merge(self):
+        other = checkout.Order(self.co_sys)
+        other.scan_item('soda')
+        other.scan_item('onion', 0.5)
+        self.order.merge(other)
+        self.assertEqual(self.order.scanned_items['soda'], 8)
+        self.assertEqual(self.order.scanned_items['onion'], 3.0)
+        self.assertEqual(self.order.return_total(), 13.00)
+        self.assertEqual(other.scanned_items, {})
+        self.assertEqual(other.return_total(), 0)
+
+    # merge requires same checkout system
+    def test_merge_bad_order(self):
+        other = checkout.Order(checkout.CheckoutSystem())
+        self.assertRaises(ValueError, self.order.merge, other)
+        self.assertRaises(ValueError, self.order.merge, self.order)
+
+class PromotionSimulatorTest(unittest.TestCase):
+    def setUp(self):
+        self.co_sys = checkout.CheckoutSystem()
+        self.co_sys.register_item('onion', 1.00, 'lbs')
+        self.co_sys.register_item('soda', 1.00)
+        self.co_sys.register_item('soup', 2.00)
+        self.co_sys.markdown('soup', 0.50)
+        order = checkout.Order(self.co_sys)
+        order.scan_item('soda', 6)
+        order.scan_item('soup')
+        self.baskets = [order, {'soda': 3, 'onion': 1.5}, {'soup': 2},
+                        {'soda': 6}]
+        self.sim = checkout.PromotionSimulator(self.co_sys, self.baskets)
+
+    # base revenue and discount
+    def test_base(self):
+        self.assertEqual(self.sim.revenue, 21.00)
+        self.assertEqual(self.sim.discount, 1.50)
+
+    # scenarios priced without changing checkout system
+    def test_run(self):
+        results = self.sim.run({
+            'bogo': [('buy_n_get_m', 'soda', 2, 1, 100, 6)],
+            'n_for_x': [('n_for_x', 'soda', 3, 2.00)],
+            'price': [('update_price', 'soup', 3.00),
+                      ('remove_markdown', 'soup')]})
+        self.assertEqual(results['bogo'], (16.00, -5.00, 6.50, 5.00, 3))
+        self.assertEqual(results['n_for_x'], (16.00, -5.00, 6.50, 5.00, 3))
+        self.assertEqual(results['price'], (25.50, 4.50, 0.00, -1.50, 2))
+        self.assertEqual(self.co_sys.items['soda'].special, None)
+        self.assertEqual(self.co_sys.items['soup'].markdown, 0.50)
+
+    # revenue matches replaying baskets with changed checkout system
+    def test_matches_replay(self):
+        result = self.sim.simulate([('n_for_x', 'soda', 4, 3.00, 4),
+                                    ('markdown', 'onion', 0.25)])
+        self.co_sys.n_for_x('soda', 4, 3.00, 4)
+        self.co_sys.markdown('onion', 0.25)
+        replay = checkout.PromotionSimulator(self.co_sys, self.baskets)
+        self.assertAlmostEqual(result.revenue, replay.revenue)
+        self.assertAlmostEqual(result.discount, replay.discount)
+
+    # invalid scenarios raise errors
+    def test_bad_changes(self):
+        self.assertRaises(ValueError, self.sim.simulate,
+                          [('unregister_item', 'soda')])
+        self.assertRaises(ValueError, self.sim.simulate,
+                          [('markdown', 'soda', 2.00)])
+        self.assertRaises(KeyError, self.sim.simulate,
+                          [('markdown', 'ham', 0.10)])
+
+class PricingTraceTest(unittest.TestCase):
+    def setUp(self):
+        self.co_sys = checkout.CheckoutSystem()
+        self.co_sys.register_item('onion', 1.00, 'lbs')
+        self.co_sys.register_item('soda', 1.00)
+        self.co_sys.register_item('soup', 2.00)
+        self.co_sys.markdown('soup', 0.50)
+        self.co_sys.buy_n_get_m('soda', 2, 1, 100, 6)
+        self.co_sys.n_for_x('onion', 2, 1.50)
+
+    # pricing steps for each special branch
+    def test_explain_price(self):
+        self.assertEqual(self.co_sys.explain_price('soda', 2)[1],
+                         ('buy_n_get_m', 'qty<=N'))
+        self.assertEqual(self.co_sys.explain_price('soda', 5)[1],
+                         ('buy_n_get_m', 'rem<=N'))
+        self.assertEqual(self.co_sys.explain_price('soup', 1)[1], ('markdown',))
+        self.co_sys.buy_n_get_m('soup', 1, 2, 50)
+        self.assertEqual(self.co_sys.explain_price('soup', 5)[1],
+                         ('markdown', 'buy_n_get_m', 'rem>N'))
+        self.assertEqual(self.co_sys.explain_price('soda', 7),
+                         (5.00, ('limit', 'buy_n_get_m', 'rem<=N')))
+        self.assertEqual(self.co_sys.explain_price('onion', 1.5)[1],
+                         ('n_for_x', 'qty<N'))
+
+    # trace records each recalculation and line
+    def test_trace(self):
+        order = checkout.Order(self.co_sys, trace_rate=1)
+        order.scan_item('soda', 7)
+        order.scan_item('soup')
+        order.void(['soup'])
+        self.assertEqual(order.return_total(), 5.00)
+        spans = order.trace.spans
+        self.assertEqual([span.label for span in spans],
+                         ['calculate_total', 'calculate_total', 'reprice'])
+        line = spans[1].lines[0]
+        self.assertEqual((line.name, line.qty, line.price), ('soda', 7, 5.00))
+        self.assertEqual(line.branch, ('limit', 'buy_n_get_m', 'rem<=N'))
+
+    # sharded system reports pricing steps from owning shard
+    def test_explain_price_sharded(self):
+        with checkout.ShardedCheckoutSystem(2) as co_sys:
+            co_sys.register_item('soda', 1.00)
+            co_sys.buy_n_get_m('soda', 2, 1, 100, 6)
+            order = checkout.Order(co_sys, trace_rate=1)
+            order.scan_item('soda', 7)
+            line = order.trace.spans[-1].lines[0]
+            self.assertEqual((line.price, line.branch),
+                             (5.00, ('limit', 'buy_n_get_m', 'rem<=N')))
+
+    # split of traced order is traced
+    def test_split_traced(self):
+        order = checkout.Order(self.co_sys, trace_rate=1)
+        order.scan_item('soda', 3)
+        order.scan_item('soup')
+        new_order = order.split(['soup'])
+        self.assertIsNot(new_order.trace, order.trace)
+        self.assertEqual(new_order.trace.spans[0].lines[0].name, 'soup')
+        self.assertIsNone(checkout.Order(self.co_sys).split([]).trace)
+
+    # export for chrome trace and flamegraph viewers
+    def test_export(self):
+        order = checkout.Order(self.co_sys, trace_rate=1)
+        order.scan_item('onion', 3.0)
+        order.scan_item('onion', 1.0)
+        trace = json.loads(json.dumps(order.trace.to_chrome_trace(pid=3)))
+        events = trace['traceEvents']
+        self.assertEqual([e['name'] for e in events],
+                         ['calculate_total', 'onion'] * 2)
+        self.assertEqual(events[1]['args']['branch'], 'n_for_x/qty>=N')
+        self.assertEqual(events[1]['pid'], 3)
+        stacks = order.trace.to_folded().splitlines()
+        self.assertEqual(len(stacks), 1)
+        self.assertTrue(stacks[0].startswith(
+            'calculate_total;onion;n_for_x;qty>=N '))
+
+    # tracing is sampled and off by default
+    def test_sampling(self):
+        self.assertIsNone(checkout.Order(self.co_sys).trace)
+        self.assertIsNone(checkout.Order(self.co_sys, trace_rate=0).trace)
+        self.assertRaises(ValueError, checkout.Order, self.co_sys, 1.5)
+
+class ReplayScanLogTest(unittest.TestCase):
+    def setUp(self):
+        self.co_sys = checkout.CheckoutSystem()
+        self.co_sys.register_item('onion', 1.00, 'lbs')
+        self.co_sys.register_item('soda', 1.00)
+        self.co_sys.n_for_x('soda', 3, 2.00)
+        self.totals = []
+
+    def replay(self, text, chunk_size=16):
+        with tempfile.NamedTemporaryFile('w', suffix='.log',
+                                         delete=False) as f:
+            f.write(text)
+        self.addCleanup(os.remove, f.name)
+        return checkout.replay_scan_log(
+            f.name, self.co_sys,
+            lambda lane, order_id, total: self.totals.append(
+                (lane, order_id, total)),
+            chunk_size)
+
+    # interleaved orders are totaled when closed
+    def test_replay(self):
+        stats = self.replay('# lane,order,action,item,qty\n'
+                            '1,100,scan,soda,2\n'
+                            '2,200,scan,onion,2.5\n'
+                            '1,100,scan,soda,1\n'
+                            '2,200,remove,onion,1.0\n'
+                            '\n'
+                            '1,100,close,,\n'
+                            '1,101,scan,soda,1\r\n'
+                            '2,200,close,,\n')
+        self.assertEqual(self.totals, [('1', '100', 2.00), ('2', '200', 1.50),
+                                       ('1', '101', 1.00)])
+        self.assertEqual(stats.events, 7)
+        self.assertEqual(stats.orders, 3)
+        self.assertEqual(stats.unfinished, 1)
+        self.assertGreater(stats.events_per_second, 0)
+
+    # results do not depend on chunk size
+    def test_chunk_size(self):
+        text = ''.join('{},{},scan,soda,{}\n'.format(i % 3, i % 7, i % 4 + 1)
+                       for i in range(200))
+        self.replay(text, chunk_size=1 << 20)
+        expected = sorted(self.totals)
+        for chunk_size in (1, 7, 64):
+            self.totals = []
+            self.replay(text, chunk_size)
+            self.assertEqual(sorted(self.totals), expected)
+
+    # empty log
+    def test_empty(self):
+        stats = self.replay('')
+        self.assertEqual((stats.events, stats.orders), (0, 0))
+
+    # errors give line number
+    def test_errors(self):
+        with self.assertRaisesRegex(ValueError, 'line 2'):
+            self.replay('1,1,scan,onion,1\n1,1,scan,soda,1.5\n')
+        with self.assertRaisesRegex(KeyError, 'line 1'):
+            self.replay('1,1,scan,ham,1\n')
+        self.assertRaises(ValueError, self.replay, '1,1,scan,soda\n')
+        self.assertRaises(ValueError, self.replay, '1,1,void,soda,1\n')
+        self.assertRaises(ValueError, self.replay, '1,1,remove,soda,1\n')
+
+    # closing an order that is not open is an error
+    def test_close_not_open(self):
+        with self.assertRaisesRegex(ValueError, 'line 1: order not open'):
+            self.replay('1,9,close,,\n')
+        with self.assertRaisesRegex(ValueError,
+                                    'line 3: order already closed'):
+            self.replay('1,9,scan,soda,1\n1,9,close,,\n1,9,close,,\n')
+        self.assertEqual(self.totals, [('1', '9', 1.00)])
+
+    # events for a recently closed order are an error
+    def test_event_after_close(self):
+        with self.assertRaisesRegex(ValueError,
+                                    'line 3: order already closed'):
+            self.replay('1,1,scan,soda,1\n1,1,close,,\n1,1,scan,soda,2\n')
+        self.assertEqual(self.totals, [('1', '1', 1.00)])
+
+    # ids closed longer ago than closed_window may be reused
+    def test_closed_window(self):
+        text = ('1,1,scan,soda,1\n1,1,close,,\n'
+                '1,2,scan,soda,1\n1,2,close,,\n'
+                '1,1,scan,soda,2\n1,1,close,,\n')
+        with tempfile.NamedTemporaryFile('w', suffix='.log',
+                                         delete=False) as f:
+            f.write(text)
+        self.addCleanup(os.remove, f.name)
+        checkout.replay_scan_log(
+            f.name, self.co_sys,
+            lambda *total: self.totals.append(total), closed_window=1)
+        self.assertEqual(self.totals, [('1', '1', 1.00), ('1', '2', 1.00),
+                                       ('1', '1', 2.00)])
+
+class ChangeFeedTest(unittest.TestCase):
+    def setUp(self):
+        self.co_sys = checkout.CheckoutSystem()
+        self.co_sys.register_item('onion', 1.00, 'lbs')
+        self.co_sys.register_item('soda', 1.00)
+        self.sub = self.co_sys.changes.subscribe()
+
+    # mutations emit events with sequence numbers
+    def test_events(self):
+        self.co_sys.update_price('soda', 2.00)
+        self.co_sys.n_for_x('onion', 2, 1.50)
+        self.co_sys.remove_all_markdowns()
+        events = self.sub.poll()
+        self.assertEqual([(e.seq, e.name, e.field, e.value) for e in events],
+                         [(3, 'soda', 'price', 2.00),
+                          (4, 'onion', 'special', [2, 2, 1.50, None]),
+                          (5, None, 'markdown', None)])
+        self.assertEqual(self.sub.poll(), [])
+
+    # failed mutations emit nothing
+    def test_no_event_on_error(self):
+        self.assertRaises(ValueError, self.co_sys.markdown, 'soda', 5.00)
+        self.assertRaises(KeyError, self.co_sys.remove_special, 'ham')
+        self.assertEqual(self.sub.poll(), [])
+
+    # later changes replace earlier ones
+    def test_coalesce(self):
+        self.co_sys.update_price('soda', 2.00)
+        self.co_sys.markdown('soda', 0.50)
+        self.co_sys.update_price('soda', 3.00)
+        self.co_sys.markdown('onion', 0.25)
+        self.co_sys.remove_all_markdowns()
+        self.co_sys.unregister_item('soda')
+        self.co_sys.register_item('soda', 4.00)
+        events = self.sub.poll()
+        self.assertEqual([(e.name, e.field, e.value) for e in events],
+                         [(None, 'markdown', None),
+                          ('soda', 'item', (4.00, 'unit'))])
+        self.assertEqual([(e.name, e.field) for e in
+                          self.co_sys.changes.since(0)],
+                         [('onion', 'item'), (None, 'markdown'),
+                          ('soda', 'item')])
+
+    # bursts of updates to one item do not overflow buffer
+    def test_burst_no_reset(self):
+        co_sys = checkout.CheckoutSystem()
+        co_sys.changes = checkout.ChangeFeed(maxlen=4)
+        co_sys.register_item('soda', 1.00)
+        co_sys.register_item('onion', 1.00, 'lbs')
+        sub = co_sys.changes.subscribe()
+        for i in range(2000):
+            co_sys.update_price('soda', 1.00 + i)
+            co_sys.markdown('onion', 0.50)
+        events = sub.poll()
+        self.assertEqual([(e.seq, e.name, e.field, e.value) for e in events],
+                         [(4001, 'soda', 'price', 2000.00),
+                          (4002, 'onion', 'markdown', 0.50)])
+
+    # slow subscriber receives reset once buffer overflows
+    def test_reset(self):
+        co_sys = checkout.CheckoutSystem()
+        co_sys.changes = checkout.ChangeFeed(maxlen=2)
+        sub = co_sys.changes.subscribe()
+        for name in ('soda', 'pop', 'juice'):
+            co_sys.register_item(name, 1.00)
+        events = sub.poll()
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].field, 'reset')
+        self.assertEqual(events[0].seq, 3)
+        co_sys.update_price('soda', 1.00)
+        self.assertEqual(sub.poll()[0].value, 1.00)
+
+class ShardedCheckoutTest(unittest.TestCase):
+    def setUp(self):
+        self.co_sys = checkout.ShardedCheckoutSystem(shards=3)
+        self.names = ['item{}'.format(i) for i in range(30)]
+        for name in self.names:
+            self.co_sys.register_item(name, 1.00)
+        self.co_sys.register_item('onion', 1.00, 'lbs')
+        self.co_sys.n_for_x('item0', 3, 2.00)
+
+    def tearDown(self):
+        self.co_sys.close()
+
+    # items are spread across shards and priced on owning shard
+    def test_calc_price(self):
+        self.assertEqual(len(self.co_sys.items), 31)
+        self.assertEqual(self.co_sys.items['onion'].sold_by, 'lbs')
+        self.assertEqual(self.co_sys.calculate_price('item0', 4), 3.00)
+
+    # order total matches single process checkout system
+    def test_order_total(self):
+        order = checkout.Order(self.co_sys)
+        order.scan_item('item0', 3)
+        order.scan_item('item5', 2)
+        order.scan_item('onion', 1.5)
+        self.assertEqual(order.return_total(), 5.50)
+        self.assertRaises(ValueError, order.scan_item, 'item7', 1.5)
+
+    # KeyError from shard is raised in caller
+    def test_no_item(self):
+        self.assertRaises(KeyError, self.co_sys.markdown, 'ham', 0.50)
+        self.assertRaises(KeyError, self.co_sys.calculate_prices,
+                          [('item1', 1), ('ham', 1)])
+        self.assertEqual(self.co_sys.calculate_price('item1', 2), 2.00)
+
+    # adding a shard only moves items owned by the new shard
+    def test_add_shard(self):
+        before = {n: self.co_sys._topology[0].owner(n) for n in self.names}
+        shard_id = self.co_sys.add_shard()
+        for name in self.names:
+            owner = self.co_sys._topology[0].owner(name)
+            self.assertIn(owner, (before[name], shard_id))
+        self.assertEqual(len(self.co_sys.items), 31)
+        self.assertEqual(self.co_sys.calculate_price('item0', 3), 2.00)
+
+    # mutations forwarded to shards are recorded in change feed
+    def test_changes(self):
+        sub = self.co_sys.changes.subscribe()
+        self.co_sys.markdown('item3', 0.50)
+        self.co_sys.remove_all_specials()
+        self.assertEqual([(e.name, e.field) for e in sub.poll()],
+                         [('item3', 'markdown'), (None, 'special')])
+
+    # failed broadcast leaves no unread replies in shard pipes
+    def test_broadcast_error(self):
+        self.assertRaises(KeyError, self.co_sys._broadcast,
+                          'unregister_item', 'item0')
+        self.assertEqual(self.co_sys.calculate_price('item1', 2), 2.00)
+        self.assertEqual(len(self.co_sys.items), 30)
+
+    # threads sharing one system always get their own item's price
+    def test_threads(self):
+        for i, name in enumerate(self.names):
+            self.co_sys.update_price(name, 1.00 + i)
+        errors = []
+
+        def price_items(offset):
+            try:
+                for i in range(200):
+                    idx = (i + offset) % len(self.names)
+                    name = self.names[idx]
+                    if i % 3 == 0:
+                        got = self.co_sys.calculate_prices(
+                            [(name, 1), ('item1', 2)])
+                        expected = [1.00 + idx, 4.00]
+                    else:
+                        got = self.co_sys.calculate_price(name, 1)
+                        expected = 1.00 + idx
+                    if got != expected:
+                        errors.append((name, got, expected))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=price_items, args=(n,))
+                   for n in range(8)]
+        threads.append(threading.Thread(target=self.co_sys.add_shard))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.co_sys.shard_ids), 4)
+
+    # RuntimeError after close
+    def test_closed(self):
+        self.co_sys.close()
+        self.assertRaises(RuntimeError, self.co_sys.calculate_price, 'item1', 1)
+        self.assertRaises(RuntimeError, self.co_sys.calculate_prices,
+                          [('item1', 1)])
+        self.assertRaises(RuntimeError, self.co_sys.remove_all_specials)
+        self.assertRaises(RuntimeError, self.co_sys.add_shard)
+
+    # removing a shard keeps its items
+    def test_remove_shard(self):
+        self.co_sys.remove_shard(self.co_sys.shard_ids[0])
+        self.assertEqual(len(self.co_sys.shard_ids), 2)
+        self.assertEqual(len(self.co_sys.items), 31)
+        self.assertRaises(KeyError, self.co_sys.remove_shard, 99)
+
+def _shared_catalog_price(name, item, qty, queue):
+    catalog = checkout.SharedCatalog.attach(name)
+    queue.put(catalog.calculate_price(item, qty))
+    catalog.close()
+
+@unittest.skipIf(checkout.shared_memory is None, 'requires Python 3.8+')
+class SharedCatalogTest(unittest.TestCase):
+    def setUp(self):
+        self.catalog = checkout.SharedCatalog(capacity=8)
+        self.catalog.register_item('onion', 1.00, 'lbs')
+        self.catalog.register_item('soda', 1.00)
+        self.reader = checkout.SharedCatalog.attach(self.catalog.name)
+
+    def tearDown(self):
+        self.reader.close()
+        self.catalog.close()
+
+    # reader sees items, markdowns and specials written by writer
+    def test_read_item(self):
+        self.catalog.markdown('soda', 0.50)
+        self.catalog.buy_n_get_m('soda', 2, 1, 100, 6)
+        self.catalog.n_for_x('onion', 2, 1.50)
+        item = self.reader.items['soda']
+        self.assertEqual(item.markdown, 0.50)
+        self.assertEqual(item.special, [3, 2, 1, 100, 6])
+        self.assertEqual(self.reader.items['onion'].special, [2, 2, 1.50, None])
+        self.assertEqual(self.reader.items['onion'].sold_by, 'lbs')
+        self.assertEqual(self.reader.calculate_price('soda', 9), 3.50)
+
+    # updates are visible to reader without reattaching
+    def test_update_in_place(self):
+        self.assertEqual(self.reader.calculate_price('soda', 2), 2.00)
+        self.catalog.update_price('soda', 2.00)
+        self.catalog.register_item('bread', 3.00)
+        self.assertEqual(self.reader.calculate_price('soda', 2), 4.00)
+        self.assertEqual(self.reader.calculate_price('bread', 1), 3.00)
+        self.catalog.remove_all_markdowns()
+        self.catalog.remove_all_specials()
+        self.assertEqual(len(self.reader.items), 3)
+
+    # writer records changes in its change feed
+    def test_changes(self):
+        sub = self.catalog.changes.subscribe()
+        self.catalog.update_price('soda', 2.00)
+        self.assertEqual(sub.poll()[0].value, 2.00)
+
+    # removed items raise KeyError in reader
+    def test_unregister_item(self):
+        self.catalog.unregister_item('soda')
+        self.assertRaises(KeyError, self.reader.calculate_price, 'soda', 1)
+        self.assertEqual(sorted(self.reader.items), ['onion'])
+
+    # slots of removed items are reused
+    def test_churn(self):
+        for i in range(20):
+            name = 'item{}'.format(i)
+            self.catalog.register_item(name, 1.00 + i)
+            self.assertEqual(self.reader.calculate_price(name, 1), 1.00 + i)
+            self.catalog.unregister_item(name)
+            self.assertRaises(KeyError, self.reader.calculate_price, name, 1)
+        self.catalog.unregister_item('onion')
+        for i in range(7):
+            self.catalog.register_item('new{}'.format(i), 2.00)
+        self.assertEqual(len(self.reader.items), 8)
+        self.assertRaises(ValueError, self.catalog.register_item, 'ham', 1.00)
+        self.assertEqual(self.reader.calculate_price('soda', 2), 2.00)
+
+    # validation errors and read-only reader
+    def test_errors(self):
+        self.assertRaises(ValueError, self.catalog.markdown, 'soda', 2.00)
+        self.assertRaises(KeyError, self.catalog.markdown, 'ham', 0.10)
+        self.assertRaises(RuntimeError, self.reader.update_price, 'soda', 2.00)
+        self.assertRaises(ValueError, self.catalog.register_item, 'x' * 65, 1.00)
+        for i in range(6):
+            self.catalog.register_item('item{}'.format(i), 1.00)
+        self.assertRaises(ValueError, self.catalog.register_item, 'ham', 1.00)
+
+    # reader started outside multiprocessing does not delete block on exit
+    def test_attach_from_subprocess(self):
+        code = ('import checkout; c = checkout.SharedCatalog.attach({!r}); '
+                'print(c.calculate_price("soda", 2)); c.close()'
+                .format(self.catalog.name))
+        out = subprocess.run([sys.executable, '-c', code],
+                             cwd=os.path.dirname(os.path.abspath(__file__)),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True, timeout=30)
+        self.assertEqual(out.stdout.strip(), '2.0')
+        self.assertEqual(out.stderr, '')
+        reader = checkout.SharedCatalog.attach(self.catalog.name)
+        self.assertEqual(reader.calculate_price('soda', 1), 1.00)
+        reader.close()
+
+    # reads fail instead of hanging if writer stops mid-update
+    def test_stalled_writer(self):
+        buf = self.catalog._buf
+        seq, generation, used = self.catalog._HEADER.unpack_from(buf, 0)
+        self.catalog._HEADER.pack_into(buf, 0, seq + 1, generation, used)
+        self.reader.read_timeout = 0.01
+        self.assertRaises(RuntimeError, self.reader.calculate_price, 'soda', 1)
+        self.catalog._HEADER.pack_into(buf, 0, seq + 2, generation, used)
+        self.assertEqual(self.reader.calculate_price('soda', 1), 1.00)
+
+    # order total from worker process
+    def test_worker_process(self):
+        self.catalog.n_for_x('soda', 3, 2.00)
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=_shared_catalog_price,
+            args=(self.catalog.name, 'soda', 4, queue))
+        process.start()
+        self.assertEqual(queue.get(timeout=10), 3.00)
+        process.join()
+
+# Differential testing: random catalogs, specials and scan/remove sequences
+# are priced by every pricing path in checkout and compared against the
+# reference pricer below. The reference is a frozen copy of the original
+# CheckoutSystem.calculate_price/calculate_special and must not be changed
+# to match new code. Set CHECKOUT_FUZZ_CASES and CHECKOUT_FUZZ_SEED to run
+# more cases or replay a failure.
+
+def _reference_special(params, price, qty):
+    if params[0] == 2:
+        N = params[1]
+        X = params[2]
+        if qty >= N:
+            return (qty // N) * X + (qty % N) * price
+        else:
+            return price * qty
+
+    if params[0] == 3:
+        N = params[1]
+        M = params[2]
+        X = 1 - params[3] / 100
+
+        if qty > N:
+            total = 0
+            m_price = price * X
+            special_price = (N * price) + (M * m_price)
+
+            special_count = qty // (N + M)
+            total += special_count * special_price
+
+            rem = qty % (N + M)
+            if rem > N:
+                total += (N * price) + ((rem - N) * m_price)
+            else:
+                total += rem * price
+            return total
+        else:
+            return price * qty
+
+def _reference_price(price, markdown, params, qty):
+    if params is None and markdown is None:
+        return price * qty
+    elif params is None and markdown is not None:
+        return (price - markdown) * qty
+    else:
+        limit = params[-1]
+        if markdown is not None:
+            price -= markdown
+        if limit is not None and qty > limit:
+            return price * (qty-limit) + \
+                _reference_special(params, price, limit)
+        else:
+            return _reference_special(params, price, qty)
+
+def _random_case(rng):
+    items = []
+    for i in range(rng.randint(1, 5)):
+        price = round(rng.uniform(0.01, 10), 2)
+        sold_by = rng.choice(['unit', 'unit', 'lbs'])
+        markdown = None
+        if rng.random() < 0.3:
+            markdown = round(rng.uniform(0, price), 2)
+        special = None
+        kind = rng.random()
+        if kind < 0.35:
+            N = rng.randint(1, 5)
+            limit = rng.choice([None, N * rng.randint(1, 3)])
+            special = ('n_for_x', N, round(rng.uniform(0.01, price * N), 2),
+                       limit)
+        elif kind < 0.7:
+            N, M = rng.randint(1, 4), rng.randint(1, 3)
+            limit = rng.choice([None, (N + M) * rng.randint(1, 3)])
+            special = ('buy_n_get_m', N, M, rng.randint(1, 100), limit)
+        items.append(('item{}'.format(i), price, sold_by, markdown, special))
+
+    ops = []
+    for _ in range(rng.randint(1, 12)):
+        name, _, sold_by, _, _ = rng.choice(items)
+        if sold_by == 'unit':
+            qty = rng.randint(1, 12)
+        else:
+            qty = round(rng.uniform(0.01, 12), 2)
+        ops.append((rng.choice(['scan', 'scan', 'remove']), name, qty))
+    return {'items': items, 'ops': ops}
+
+def _build_checkout(case, co_sys=None):
+    if co_sys is None:
+        co_sys = checkout.CheckoutSystem()
+    for name, price, sold_by, markdown, special in case['items']:
+        co_sys.register_item(name, price, sold_by)
+        if markdown is not None:
+            co_sys.markdown(name, markdown)
+        if special is not None:
+            getattr(co_sys, special[0])(name, *special[1:])
+    return co_sys
+
+def _reference_total(case):
+    items = {item[0]: item for item in case['items']}
+    scanned = {}
+    for op, name, qty in case['ops']:
+        if op == 'scan':
+            scanned[name] = scanned.get(name, 0) + qty
+        elif name in scanned:
+            if qty >= scanned[name]:
+                scanned.pop(name)
+            else:
+                scanned[name] -= qty
+
+    lines = []
+    for name, qty in scanned.items():
+        _, price, _, markdown, special = items[name]
+        params = None
+        if special is not None:
+            params = [2 if special[0] == 'n_for_x' else 3] + list(special[1:])
+        lines.append((name, qty, _reference_price(price, markdown, params,
+                                                  qty)))
+    total = 0
+    for _, _, price in lines:
+        total += price
+    return lines, total
+
+def _replay(case, order, use_void=False):
+    for op, name, qty in case['ops']:
+        if op == 'scan':
+            order.scan_item(name, qty)
+        elif name in order.scanned_items:
+            if use_void:
+                order.void({name: qty})
+            else:
+                order.remove_item_qty(name, qty)
+    return order
+
+def _check_case(case, shared=False, sharded=False):
+    """Returns a description of the first mismatch, or None."""
+    try:
+        lines, total = _reference_total(case)
+        co_sys = _build_checkout(case)
+        for name, qty, expected in lines:
+            got = co_sys.calculate_price(name, qty)
+            if got != expected:
+                return 'calculate_price({!r}, {!r}) = {!r}, expected {!r}'\
+                    .format(name, qty, got, expected)
+            got = co_sys.explain_price(name, qty)[0]
+            if got != expected:
+                return 'explain_price({!r}, {!r}) = {!r}, expected {!r}'\
+                    .format(name, qty, got, expected)
+        got = co_sys.calculate_prices([(n, q) for n, q, _ in lines])
+        if got != [price for _, _, price in lines]:
+            return 'calculate_prices = {!r}'.format(got)
+
+        order = _replay(case, checkout.Order(co_sys))
+        if order.total != total:
+            return 'Order total {!r}, expected {!r}'.format(order.total, total)
+        order = _replay(case, checkout.Order(co_sys, trace_rate=1))
+        if order.total != total:
+            return 'traced Order total {!r}, expected {!r}'.format(order.total,
+                                                                   total)
+        order = _replay(case, checkout.Order(co_sys), use_void=True)
+        if order.total != total:
+            return 'Order.void total {!r}, expected {!r}'.format(order.total,
+                                                                 total)
+        other = order.split(list(order.scanned_items)[::2])
+        order.merge(other)
+        if abs(order.total - total) > 1e-9 * max(1, abs(total)):
+            return 'Order.split/merge total {!r}, expected {!r}'.format(
+                order.total, total)
+
+        baskets = [{name: qty} for name, qty, _ in lines]
+        sim = checkout.PromotionSimulator(co_sys, baskets)
+        if abs(sim.revenue - total) > 1e-9 * max(1, abs(total)):
+            return 'PromotionSimulator revenue {!r}, expected {!r}'.format(
+                sim.revenue, total)
+
+        if shared:
+            with _build_checkout(case, checkout.SharedCatalog(16)) as catalog:
+                order = _replay(case, checkout.Order(catalog))
+                if order.total != total:
+                    return 'SharedCatalog total {!r}, expected {!r}'.format(
+                        order.total, total)
+
+        if sharded:
+            with checkout.ShardedCheckoutSystem(2) as sharded_sys:
+                _build_checkout(case, sharded_sys)
+                got = sharded_sys.calculate_prices(
+                    [(n, q) for n, q, _ in lines])
+                if got != [price for _, _, price in lines]:
+                    return 'ShardedCheckoutSystem.calculate_prices = {!r}'\
+                        .format(got)
+                order = _replay(case, checkout.Order(sharded_sys))
+                if order.total != total:
+                    return 'ShardedCheckoutSystem total {!r}, expected {!r}'\
+                        .format(order.total, total)
+    except Exception as e:
+        return 'raised {!r}'.format(e)
+    return None
+
+def _shrink_candidates(case):
+    items, ops = case['items'], case['ops']
+    for i in range(len(ops)):
+        yield {'items': items, 'ops': ops[:i] + ops[i+1:]}
+    for i, item in enumerate(items):
+        used = [op for op in ops if op[1] != item[0]]
+        yield {'items': items[:i] + items[i+1:], 'ops': used}
+        name, price, sold_by, markdown, special = item
+        simpler = []
+        if markdown is not None:
+            simpler.append((name, price, sold_by, None, special))
+        if special is not None:
+            simpler.append((name, price, sold_by, markdown, None))
+            if special[-1] is not None:
+                simpler.append((name, price, sold_by, markdown,
+                                special[:-1] + (None,)))
+        for new_item in simpler:
+            yield {'items': items[:i] + [new_item] + items[i+1:], 'ops': ops}
+    for i, (op, name, qty) in enumerate(ops):
+        if isinstance(qty, int):
+            smaller = [q for q in (1, qty // 2, qty - 1) if 0 < q < qty]
+        else:
+            smaller = [q for q in (1.0, round(qty / 2, 2)) if 0 < q < qty]
+        for q in smaller:
+            yield {'items': items, 'ops': ops[:i] + [(op, name, q)] + ops[i+1:]}
+
+def _shrink(case, fails):
+    """Greedily simplifies a failing case while it still fails."""
+    shrunk = True
+    while shrunk:
+        shrunk = False
+        for candidate in _shrink_candidates(case):
+            if fails(candidate):
+                case = candidate
+                shrunk = True
+                break
+    return case
+
+class DifferentialTest(unittest.TestCase):
+    # all pricing paths agree with reference pricer on random cases
+    def test_random_cases(self):
+        cases = int(os.environ.get('CHECKOUT_FUZZ_CASES', 2000))
+        seed = int(os.environ.get('CHECKOUT_FUZZ_SEED', random.randrange(2**32)))
+        rng = random.Random(seed)
+        for i in range(cases):
+            case = _random_case(rng)
+            shared = checkout.shared_memory is not None and i % 50 == 0
+            sharded = i % 200 == 0
+            error = _check_case(case, shared, sharded)
+            if error is not None:
+                case = _shrink(case, lambda c: _check_case(c, shared, sharded)
+                               is not None)
+                self.fail('seed {}, case {}: {}\nshrunk case: {!r}'.format(
+                    seed, i, _check_case(case, shared, sharded), case))
+
+    # shrinking reduces a failing case to the smallest failing case
+    def test_shrink(self):
+        case = _random_case(random.Random(1))
+        case['ops'].append(('scan', case['items'][0][0], 9))
+        fails = lambda c: any(op[2] >= 5 for op in c['ops'])
+        shrunk = _shrink(case, fails)
+        self.assertEqual(len(shrunk['items']), 1)
+        self.assertEqual(len(shrunk['ops']), 1)
+        self.assertEqual(shrunk['ops'][0][2], 5)
+
+    # reference agrees with hand-picked quantities from unit tests
+    def test_reference(self):
+        self.assertEqual(_reference_price(1.00, None, [3, 2, 2, 50, 8], 12), 10)
+        self.assertEqual(_reference_price(1.00, 0.50, [2, 5, 3.00, None], 9),
+                         5.00)
+
 if __name__ == '__main__':
     unittest.main()